@@ -1,12 +1,61 @@
+import io
 import os
+import re
+import json
 import warnings
 import zipfile
-import io
+import tempfile
+import threading
+from itertools import chain, islice
+from operator import itemgetter
+from concurrent.futures import Future, ThreadPoolExecutor
 
 import pandas as pd
 import requests
 from requests.adapters import HTTPAdapter
-from .util import KEY_ENV_NAME, KEY_FILE_NAME, DEFAULT_API_URL
+from urllib3.util import make_headers
+from urllib3.util.retry import Retry
+from .util import (
+    DATA_DIR, KEY_ENV_NAME, KEY_FILE_NAME, DEFAULT_API_URL, _loads
+)
+
+try:
+    import requests_cache
+    # the cache settings used below need requests_cache >= 1.0; treat older
+    # versions as not installed
+    requests_cache.DEFAULT_IGNORED_PARAMS, requests_cache.DO_NOT_CACHE
+except (ImportError, AttributeError):
+    requests_cache = None
+
+try:
+    import pyarrow.csv as pa_csv
+except ImportError:
+    pa_csv = None
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+_KEY_LEN = 152
+
+# at most this many bytes of an error response are included in QueryError
+_ERROR_BODY_BYTES = 1 << 12
+
+# responses whose decoded body is larger than this many bytes are parsed
+# incrementally with ijson
+_STREAM_THRESHOLD = 8 * 1024 * 1024
+_MISSING = object()
+_DECODER = json.JSONDecoder()
+# fill value for fields absent from a record, as pd.DataFrame(records) uses
+_NA = float("nan")
+
+_GET_ALLOWED = frozenset(("r", "px", "ps", "p", "rg", "cc", "max", "type",
+                          "freq", "head", "token", "imts"))
+_VIEW_ALLOWED = frozenset(("r", "px", "ps", "type", "freq", "token"))
+_GET_BULK_ALLOWED = frozenset(("r", "px", "ps", "type", "freq", "token"))
+_VIEW_BULK_ALLOWED = frozenset(("r", "px", "ps", "type", "freq", "from",
+                                "token"))
 
 
 class QueryError(Exception):
@@ -16,16 +65,188 @@ class QueryError(Exception):
 
 
 class ComtradeResult(object):
-    def __init__(self, validation, dataset, url):
+    def __init__(self, validation, dataset, url, lazy=False):
         self.validation = validation
-        self.df = pd.DataFrame(dataset)
         self.url = url
+        # only hold on to the raw records when the frame is deferred, so
+        # eager results don't keep two copies of the data alive
+        self.dataset = dataset if lazy else None
+        self._df = None if lazy else _to_frame(dataset)
+
+    @property
+    def df(self):
+        if self._df is None:
+            self._df = _to_frame(self.dataset)
+        return self._df
+
+
+def _to_frame(dataset):
+    if isinstance(dataset, pd.DataFrame):
+        return dataset
+    if isinstance(dataset, dict):
+        # already split into columns by _stream_validation_dataset
+        return pd.DataFrame(dataset, copy=False)
+    if not dataset:
+        return pd.DataFrame()
+
+    return pd.DataFrame(_to_columns(dataset), copy=False)
+
+
+def _to_columns(records):
+    # transpose the list of records into columns once rather than letting
+    # pandas walk the records row by row
+    keys = list(records[0])
+    if len(set(map(len, records))) == 1:
+        try:
+            return {k: list(map(itemgetter(k), records)) for k in keys}
+        except KeyError:
+            pass
+
+    # ragged records: use every field seen, in order of first appearance
+    keys = dict.fromkeys(k for row in records for k in row)
+    return {k: [row.get(k, _NA) for row in records] for k in keys}
+
+
+def _make_retry(total):
+    kw = dict(total=total, backoff_factor=0.5,
+              status_forcelist=(429, 500, 502, 503, 504),
+              allowed_methods=frozenset(["GET"]),
+              respect_retry_after_header=True, raise_on_status=False)
+    try:
+        return Retry(backoff_jitter=0.5, **kw)
+    except TypeError:
+        # urllib3 < 2.0 doesn't support jitter
+        return Retry(**kw)
+
+
+def _stream_validation_dataset(chunks, batch_size=10000):
+    """
+    Incrementally parse a ``{"validation": ..., "dataset": [...]}`` response
+    from an iterable of byte chunks. Records are built by ijson's C backend
+    and moved into per-column lists in batches, so at most ``batch_size``
+    record dicts are alive at once. Returns ``(validation, columns, nrows)``;
+    ``validation`` is ``_MISSING`` if the key was not present.
+
+    This trades speed for memory: it is slower than parsing the whole body
+    with ``_loads``, but peak memory is a fraction of it.
+    """
+    reader = _ChunkReader(chunks)
+    rows = ijson.items(reader, "dataset.item", use_float=True)
+    cols = {}
+    n = 0
+    for batch in iter(lambda: list(islice(rows, batch_size)), []):
+        n = _extend_columns(cols, batch, n)
+
+    return _find_validation(reader.head, reader.tail), cols, n
+
+
+def _find_validation(head, tail):
+    # The validation object is small and sent before the dataset, so look for
+    # it in the first bytes of the body rather than running a second parser
+    # over the whole response
+    try:
+        for validation in ijson.items(io.BytesIO(head), "validation",
+                                      use_float=True):
+            return validation
+    except ijson.JSONError:
+        pass
+
+    # otherwise it can only be the last key of the document
+    i = tail.rfind(b'"validation"')
+    if i < 0:
+        return _MISSING
+    rest = tail[i + len(b'"validation"'):].decode().lstrip()
+    if not rest.startswith(":"):
+        return _MISSING
+    try:
+        validation, end = _DECODER.raw_decode(rest[1:].lstrip())
+    except ValueError:
+        return _MISSING
+    if rest[1:].lstrip()[end:].strip() != "}":
+        return _MISSING
+    return validation
+
+
+def _extend_columns(cols, rows, n):
+    # append a batch of records to cols, which already holds n rows
+    batch = _to_columns(rows)
+    m = len(rows)
+    for k in cols.keys() - batch.keys():
+        cols[k].extend([_NA] * m)
+    for k, v in batch.items():
+        if k not in cols:
+            cols[k] = [_NA] * n
+        cols[k].extend(v)
+    return n + m
+
+
+class _ChunkReader(object):
+    # minimal file-like wrapper so ijson can consume an iterator of chunks.
+    # The first and last bytes read are kept for _find_validation
+    def __init__(self, chunks, keep=1 << 16):
+        self._chunks = chunks
+        self._keep = keep
+        self.head = b""
+        self.tail = b""
+
+    def read(self, size=-1):
+        # ijson probes with read(0) to tell bytes from str
+        if size == 0:
+            return b""
+        chunk = next(self._chunks, b"")
+        if len(self.head) < self._keep:
+            self.head += chunk[:self._keep]
+        self.tail = (self.tail + chunk)[-self._keep:]
+        return chunk
+
+
+def _query_key(params):
+    # hashable key identifying a set of query parameters, or None if one of
+    # the values can't be hashed
+    key = tuple(sorted((k, tuple(v) if isinstance(v, list) else v)
+                       for k, v in params.items()))
+    try:
+        hash(key)
+    except TypeError:
+        return None
+    return key
 
 
 class Comtrade(object):
-    def __init__(self, url=DEFAULT_API_URL, token=None, max_retries=3):
+    """
+    Client for the UN Comtrade API
+
+    Parameters
+    ----------
+    url: str, optional(default=DEFAULT_API_URL)
+        Base url of the API
+
+    token: str, optional
+        API token. If not given, it is read from the ``COMTRADE_TOKEN``
+        environment variable or the ``~/.comtraderc`` file
+
+    max_retries: int, optional(default=3)
+        Number of times a failed request is retried, with exponential backoff
+
+    cache_ttl: int, optional(default=3600)
+        Number of seconds responses to ``get`` and ``refs/da/*`` queries are
+        cached on disk when ``requests_cache`` is installed. ``None`` disables
+        the cache
+
+    max_bytes: int, optional(default=None)
+        Largest response body, in decoded (uncompressed) bytes, that will be
+        read before the request is aborted with a ``QueryError``. Note that
+        responses eligible for the HTTP cache are read in full by
+        ``requests_cache`` before this limit is checked
+
+    """
+    def __init__(self, url=DEFAULT_API_URL, token=None, max_retries=3,
+                 cache_ttl=3600, max_bytes=None):
         self.url = url
-        self.token = None
+        self.max_bytes = max_bytes
+        self.token = token
+        self._inflight = {}
+        self._inflight_lock = threading.Lock()
 
         if token is None:
             if KEY_ENV_NAME in os.environ:
@@ -36,39 +257,107 @@ class Comtrade(object):
             else:
                 msg = "Comtrade token not detected, usage may be limited."
                 warnings.warn(msg)
-                return
 
         if self.token is not None:
-            key_len = 152
-            if len(self.token) > key_len:
-                self.token = token[:key_len]
-                m = f"API token too long, using first {key_len} characters"
+            self.token = self.token.strip()
+            if len(self.token) != _KEY_LEN:
+                if len(self.token) < _KEY_LEN:
+                    m = (f"API token too short ({len(self.token)} chars). "
+                         f"Should be {_KEY_LEN} chars")
+                    raise ValueError(m)
+                self.token = self.token[:_KEY_LEN]
+                m = f"API token too long, using first {_KEY_LEN} characters"
                 warnings.warn(m)
-            elif len(self.token) < key_len:
-                m = f"API token {token} too short. Should be {key_len} chars"
-                raise ValueError(m)
 
-        self.sess = requests.Session()
-        self.sess.mount(self.url, HTTPAdapter(max_retries=max_retries))
+        if requests_cache is not None and cache_ttl is not None:
+            # only cache the data queries; never token/user info responses
+            # (which carry credentials) or multi-MB bulk archives
+            data_urls = re.compile(re.escape(self.url) + r"(get\?|refs/da/)")
+            ignored = requests_cache.DEFAULT_IGNORED_PARAMS
+            self.sess = requests_cache.CachedSession(
+                cache_name=os.path.join(DATA_DIR, "http_cache"),
+                backend="sqlite", allowable_methods=("GET",),
+                urls_expire_after={
+                    data_urls: cache_ttl,
+                    "*": requests_cache.DO_NOT_CACHE,
+                },
+                ignored_parameters=tuple(ignored) + ("token", "password"),
+            )
+        else:
+            self.sess = requests.Session()
+
+        # only advertise encodings (e.g. br) that urllib3 can actually decode
+        self.sess.headers.update(make_headers(keep_alive=True,
+                                              accept_encoding=True))
+        adapter = HTTPAdapter(max_retries=_make_retry(max_retries),
+                              pool_connections=16, pool_maxsize=32)
+        self.sess.mount(self.url, adapter)
 
     def _make_request(self, method, **params):
+        # the body is left unread; consume it through _read or _iter_content
+        # so that max_bytes is enforced
         url = self.url + method
-        r = self.sess.get(url, params=params)
+        r = self.sess.get(url, params=params, stream=True)
+
         if r.status_code != 200:
+            # only show the start of the error body, independent of
+            # max_bytes, so the status code is always what gets reported
+            with r:
+                body = next(r.iter_content(_ERROR_BODY_BYTES), b"")
             msg = f"Query failed with status code {r.status_code}. "
-            msg += f"Response from server was\n{r.content}"
+            msg += f"Response from server was\n{body}"
+            raise QueryError(msg, r)
+
+        # Content-Length only gives the decoded size for uncompressed bodies
+        size = int(r.headers.get("Content-Length", 0))
+        compressed = "Content-Encoding" in r.headers
+        if (self.max_bytes is not None and not compressed and
+                size > self.max_bytes):
+            r.close()
+            msg = f"Response of {size} bytes exceeds max_bytes "
+            msg += f"({self.max_bytes})"
             raise QueryError(msg, r)
 
         return r
 
-    def _validate_kwargs(self, method, allowed_kwargs, kwargs):
-        for k in kwargs.keys():
-            if k not in allowed_kwargs:
-                m = f"Argument {k} not allowed for method {method}"
-                raise ValueError(m)
+    def _iter_content(self, r, chunk_size=1 << 20):
+        # yield the decoded body, aborting once it grows past max_bytes
+        total = 0
+        for chunk in r.iter_content(chunk_size):
+            total += len(chunk)
+            if self.max_bytes is not None and total > self.max_bytes:
+                r.close()
+                msg = f"Response exceeds max_bytes ({self.max_bytes})"
+                raise QueryError(msg, r)
+            yield chunk
+
+    def _read(self, r):
+        return b"".join(self._iter_content(r))
 
-    def _validation_dataset_response(self, r):
-        js = r.json()
+    def _validate_kwargs(self, method, allowed_kwargs, kwargs):
+        bad = kwargs.keys() - allowed_kwargs
+        if bad:
+            k = ", ".join(sorted(bad))
+            m = f"Argument {k} not allowed for method {method}"
+            raise ValueError(m)
+
+    def _validation_dataset_response(self, r, lazy=False):
+        # Content-Length is the compressed size (or missing for chunked
+        # replies), so decide on the decoded bytes actually read instead
+        chunks = self._iter_content(r)
+        head = []
+        size = 0
+        if ijson is not None:
+            for chunk in chunks:
+                head.append(chunk)
+                size += len(chunk)
+                if size > _STREAM_THRESHOLD:
+                    chunks = chain(head, chunks)
+                    return self._stream_validation_dataset_response(
+                        r, chunks, lazy
+                    )
+
+        js = _loads(b"".join(chain(head, chunks)))
         if "validation" not in js:
             m = "Query indicates success, but doesn't contain validation"
             raise QueryError(m, r)
@@ -81,7 +370,22 @@ class Comtrade(object):
             m = "Query indicates success, but the dataset is empty"
             raise QueryError(m, r)
 
-        return ComtradeResult(js["validation"], js["dataset"], r.url)
+        return ComtradeResult(js["validation"], js["dataset"], r.url, lazy)
+
+    def _stream_validation_dataset_response(self, r, chunks, lazy=False):
+        # return the connection to the pool even if parsing fails part way
+        with r:
+            validation, cols, n = _stream_validation_dataset(chunks)
+        if validation is _MISSING:
+            m = "Query indicates success, but doesn't contain validation"
+            raise QueryError(m, r)
+
+        # the record parser can't tell a missing dataset from an empty one
+        if n == 0:
+            m = "Query indicates success, but the dataset is missing or empty"
+            raise QueryError(m, r)
+
+        return ComtradeResult(validation, cols, r.url, lazy)
 
     def get_subuser_token(self, email):
         """
@@ -100,7 +404,7 @@ class Comtrade(object):
 
         """
         r = self._make_request("getSubUserToken", email=email)
-        js = r.json()
+        js = _loads(self._read(r))
         if 'token' in js:
             return js["token"]
         else:
@@ -125,7 +429,7 @@ class Comtrade(object):
         """
         r = self._make_request("getAuthToken",
                                username=username, password=password)
-        js = r.json()
+        js = _loads(self._read(r))
         if 'token' in js:
             return js["token"]
         else:
@@ -149,11 +453,12 @@ class Comtrade(object):
         """
         token = self.token if token is None else token
         if token is not None:
-            return self._make_request("getUserInfo", token=token).json()
+            r = self._make_request("getUserInfo", token=token)
+            return _loads(self._read(r))
         else:
             raise ValueError("Cannot get user info without a token")
 
-    def get(self, **kwargs):
+    def get(self, lazy=False, **kwargs):
         """
         Get trade data
 
@@ -260,15 +565,81 @@ class Comtrade(object):
             - orig data that comply with earlier version of IMTS Concepts &
               Definitions
 
+        lazy: bool, optional(default=False)
+            If True, the ``df`` attribute of the result is only built when it
+            is first accessed and the raw records are kept as ``dataset``.
+            Large responses parsed incrementally with ijson are kept as a dict
+            mapping each field to its list of values instead. Otherwise
+            ``dataset`` is None
+
         """
-        allowed_kwargs = ["r", "px", "ps", "p", "rg", "cc", "max", "type",
-                          "freq", "head", "token", "imts"]
+        self._validate_kwargs("get", _GET_ALLOWED, kwargs)
+        key = _query_key(kwargs)
+        if key is None:
+            return self._get(lazy, kwargs)
+        return self._coalesce(("get", lazy, key), self._get, lazy, kwargs)
 
-        self._validate_kwargs("get", allowed_kwargs, kwargs)
+    def _get(self, lazy, kwargs):
         r = self._make_request("get", **kwargs)
-        return self._validation_dataset_response(r)
+        return self._validation_dataset_response(r, lazy)
+
+    def _coalesce(self, key, func, *args):
+        # concurrent callers asking for the same key share a single request
+        with self._inflight_lock:
+            fut = self._inflight.get(key)
+            leader = fut is None
+            if leader:
+                fut = self._inflight[key] = Future()
+
+        if not leader:
+            return fut.result()
+
+        try:
+            fut.set_result(func(*args))
+        except BaseException as e:
+            fut.set_exception(e)
+        finally:
+            with self._inflight_lock:
+                del self._inflight[key]
+
+        return fut.result()
+
+    def get_many(self, queries, max_concurrent=8):
+        """
+        Run several ``get`` queries concurrently
+
+        Parameters
+        ----------
+        queries: list of dict
+            Each dict holds the keyword arguments for one call to ``get``.
+            Identical queries are only sent to the server once
+
+        max_concurrent: int, optional(default=8)
+            Maximum number of requests in flight at any time
 
-    def view(self, **kwargs):
+        Returns
+        -------
+        results: list of ComtradeResult
+            One result per entry in ``queries``, in the same order
+
+        """
+        keys = []
+        unique = {}
+        for i, kw in enumerate(queries):
+            key = _query_key(kw)
+            if key is None:
+                # can't be compared with the others, so always send it
+                key = i
+            keys.append(key)
+            unique.setdefault(key, kw)
+
+        with ThreadPoolExecutor(max_workers=max_concurrent) as ex:
+            out = ex.map(lambda kw: self.get(**kw), unique.values())
+            results = dict(zip(unique, out))
+
+        return [results[k] for k in keys]
+
+    def view(self, lazy=False, **kwargs):
         """
         Get trade data
 
@@ -317,12 +688,17 @@ class Comtrade(object):
 
         token: str, optional(default=self.token)
             Authorization code
-        """
-        allowed_kwargs = ["r", "px", "ps", "type", "freq", "token"]
 
-        self._validate_kwargs("view", allowed_kwargs, kwargs)
+        lazy: bool, optional(default=False)
+            If True, the ``df`` attribute of the result is only built when it
+            is first accessed and the raw records are kept as ``dataset``.
+            Large responses parsed incrementally with ijson are kept as a dict
+            mapping each field to its list of values instead. Otherwise
+            ``dataset`` is None
+        """
+        self._validate_kwargs("view", _VIEW_ALLOWED, kwargs)
         r = self._make_request("refs/da/view", **kwargs)
-        return self._validation_dataset_response(r)
+        return self._validation_dataset_response(r, lazy)
 
     def get_bulk(self, type, freq, ps, r, px, token=None):
         """
@@ -375,15 +751,25 @@ class Comtrade(object):
             Authorization code
 
         """
-        allowed_kwargs = ["r", "px", "ps", "type", "freq", "token"]
         token = token if token is not None else self.token
         kwargs = dict(type=type, freq=freq, ps=ps, r=r, px=px, token=token)
 
-        self._validate_kwargs("get_bulk", allowed_kwargs, kwargs)
+        self._validate_kwargs("get_bulk", _GET_BULK_ALLOWED, kwargs)
         r = self._make_request(f"get/bulk/{type}/{freq}/{ps}/{r}/{px}",
                                token=token)
-        zf = zipfile.ZipFile(io.BytesIO(r.content))
-        df = pd.read_csv(zf.open(zf.namelist()[0]))
+
+        # spool the archive to disk instead of holding it in memory
+        with tempfile.TemporaryFile() as tmp:
+            with r:
+                for chunk in self._iter_content(r):
+                    tmp.write(chunk)
+            tmp.seek(0)
+            with zipfile.ZipFile(tmp) as zf, zf.open(zf.namelist()[0]) as f:
+                if pa_csv is not None:
+                    df = pa_csv.read_csv(f).to_pandas(self_destruct=True)
+                else:
+                    df = pd.read_csv(f, engine="c", low_memory=False)
+
         return ComtradeResult({}, df, r.url)
 
     def view_bulk(self, **kwargs):
@@ -440,13 +826,20 @@ class Comtrade(object):
             Authorization code
 
         """
-        allowed_kwargs = ["r", "px", "ps", "type", "freq", "from", "token"]
-
-        self._validate_kwargs("view", allowed_kwargs, kwargs)
+        self._validate_kwargs("view_bulk", _VIEW_BULK_ALLOWED, kwargs)
         r = self._make_request("refs/da/bulk", **kwargs)
         return self._validation_dataset_response(r)
 
     # HELPER METHODS!
+    def clear_cache(self):
+        """
+        Remove all responses from the on-disk HTTP cache. Does nothing if
+        ``requests_cache`` is not installed or caching was disabled by passing
+        ``cache_ttl=None``
+        """
+        if hasattr(self.sess, "cache"):
+            self.sess.cache.clear()
+
     def save_subuser_token(self, email):
         token = self.get_subuser_token(email)
         with open(KEY_FILE_NAME, "w") as f:
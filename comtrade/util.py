@@ -1,24 +1,54 @@
 import os
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
 import requests
 import pandas as pd
+from requests.adapters import HTTPAdapter
+
+try:
+    from orjson import loads as _loads
+except ImportError:
+    from json import loads as _loads
+
+try:
+    import pyarrow.csv as pa_csv
+    HAS_PYARROW = True
+except ImportError:
+    HAS_PYARROW = False
 
 DEFAULT_API_URL = "http://comtrade.un.org/api/"
 KEY_ENV_NAME = "COMTRADE_TOKEN"
 KEY_FILE_NAME = os.path.join(os.path.expanduser("~"), ".comtraderc")
 DATA_DIR = os.path.join(os.path.expanduser("~"), ".comtrade", "data")
 
+# bump whenever the on-disk metadata format changes so stale files are
+# ignored and fetched again
+_META_SCHEMA_VERSION = 2
+
+_SESSION = requests.Session()
+_SESSION.mount("https://", HTTPAdapter(pool_connections=16, pool_maxsize=16))
+
+
+def _metadata_path(root_name):
+    return os.path.join(DATA_DIR, f"{root_name}.v{_META_SCHEMA_VERSION}")
 
-def update_metadata_file(url):
+
+def update_metadata_file(url, session=_SESSION):
     print("Updating url ", url)
-    r = requests.get(url)
+    r = session.get(url)
     assert r.ok
-    js = r.json()
+    js = _loads(r.content)
     assert not js["more"]
 
     df = pd.DataFrame(js["results"])
-    fn = os.path.join(DATA_DIR, os.path.basename(url).split(".")[0])
+    fn = _metadata_path(os.path.basename(url).split(".")[0])
     print("saving to: ", fn)
-    df.to_csv(fn + ".csv")
+    if HAS_PYARROW:
+        df.to_parquet(fn + ".parquet", engine="pyarrow", compression="zstd",
+                      index=False)
+    else:
+        df.to_csv(fn + ".csv", index=False)
     return df
 
 
@@ -40,17 +70,31 @@ def update_metadata_files():
             "https://comtrade.un.org/data/cache/classificationBEC.json",
             "https://comtrade.un.org/data/cache/classificationEB02.json"]
 
-    for url in urls:
-        update_metadata_file(url)
+    with ThreadPoolExecutor(max_workers=8) as ex:
+        list(ex.map(update_metadata_file, urls))
+
+
+@functools.lru_cache(maxsize=32)
+def _read_metadata_file(fn, mtime):
+    # mtime is only part of the cache key, so rewritten files are re-read
+    if fn.endswith(".parquet"):
+        return pd.read_parquet(fn, engine="pyarrow")
+    if HAS_PYARROW:
+        return pa_csv.read_csv(fn).to_pandas()
+    return pd.read_csv(fn)
 
 
 def _get_metadata_file(root_name):
-    fn = os.path.join(DATA_DIR, root_name + ".csv")
-    if os.path.isfile(fn):
-        return pd.read_csv(fn, index_col=0)
-    else:
-        url = f"https://comtrade.un.org/data/cache/{root_name}.json"
-        return update_metadata_file(url)
+    # a csv file may exist if pyarrow was installed after it was written
+    exts = [".parquet", ".csv"] if HAS_PYARROW else [".csv"]
+    for ext in exts:
+        fn = _metadata_path(root_name) + ext
+        if os.path.isfile(fn):
+            df = _read_metadata_file(fn, os.path.getmtime(fn))
+            return df.copy()
+
+    url = f"https://comtrade.un.org/data/cache/{root_name}.json"
+    return update_metadata_file(url)
 
 
 def get_partner_areas():
@@ -70,5 +70,11 @@ setup(
     # your project is installed. For an analysis of "install_requires" vs pip"s
     # requirements files see:
     # https://packaging.python.org/en/latest/requirements.html
-    install_requires=["pandas", "requests"],
+    install_requires=["pandas", "requests", "urllib3>=1.26"],
+
+    # Optional packages that enable faster code paths. Install them with
+    #   pip install comtrade[fast]
+    extras_require={
+        "fast": ["orjson", "requests_cache>=1.0", "pyarrow", "ijson"],
+    },
 )
@@ -0,0 +1,265 @@
+import io
+import json
+import math
+
+import pandas as pd
+import pytest
+import requests
+
+from comtrade import core
+from comtrade.core import Comtrade, ComtradeResult, QueryError, _to_frame
+
+needs_ijson = pytest.mark.skipif(core.ijson is None,
+                                 reason="ijson is not installed")
+STREAMED = [False, pytest.param(True, marks=needs_ijson)]
+
+RAGGED = [
+    {"a": 1, "b": {"x": [1, 2]}},
+    {"a": 2.5, "c": "s"},
+    {"b": None},
+]
+
+
+class _Raw(io.BytesIO):
+    # stands in for urllib3's response; records when the connection is
+    # given back to the pool
+    released = False
+
+    def release_conn(self):
+        self.released = True
+
+
+def _response(body):
+    r = requests.models.Response()
+    r.status_code = 200
+    r.raw = _Raw(body)
+    r.headers["Content-Length"] = str(len(body))
+    r.url = "http://example.com/api/get"
+    return r
+
+
+def _stream(obj):
+    raw = io.BytesIO(json.dumps(obj).encode())
+    return core._stream_validation_dataset(raw)
+
+
+@pytest.fixture
+def ct():
+    return Comtrade(token="x" * 152, cache_ttl=None)
+
+
+@pytest.fixture
+def always_stream(monkeypatch):
+    monkeypatch.setattr(core, "_STREAM_THRESHOLD", 0)
+
+
+@needs_ijson
+def test_stream_ragged_records():
+    validation, cols, n = _stream({"dataset": RAGGED,
+                                   "validation": {"status": "Ok"}})
+    assert validation == {"status": "Ok"}
+    assert n == 3
+    assert list(cols) == ["a", "b", "c"]
+    assert cols["a"][:2] == [1, 2.5] and math.isnan(cols["a"][2])
+    assert cols["b"][0] == {"x": [1, 2]} and math.isnan(cols["b"][1])
+    assert cols["b"][2] is None
+
+
+@needs_ijson
+def test_stream_missing_keys():
+    validation, cols, n = _stream({"dataset": []})
+    assert validation is core._MISSING
+    assert cols == {} and n == 0
+
+    validation, cols, n = _stream({"validation": None})
+    assert validation is None
+    assert cols == {} and n == 0
+
+
+@needs_ijson
+@pytest.mark.parametrize("body, validation", [
+    (b'{"dataset": [{"a": 1}], "validation": {"n": 1.5}}', {"n": 1.5}),
+    (b'{"dataset": [{"a": 1}],\n "validation" : null }\n', None),
+    (b'{"dataset": [{"validation": 1}]}', core._MISSING),
+    (b'{"dataset": [{"a": "\\"validation\\": 2}"}]}', core._MISSING),
+])
+def test_find_validation_after_dataset(body, validation):
+    # validation isn't in the (truncated) head, so it is read from the tail
+    assert core._find_validation(body[:12], body) == validation
+    assert core._find_validation(body, body) == validation
+
+
+@needs_ijson
+@pytest.mark.parametrize("records", [
+    RAGGED,
+    [{"a": 1, "b": 2}, {"a": 3, "b": 4}],
+    [{"a": 1}, {"b": 2}],
+])
+def test_stream_and_records_give_same_frame(records):
+    validation, cols, n = _stream({"validation": {}, "dataset": records})
+    expected = pd.DataFrame(records)
+    pd.testing.assert_frame_equal(_to_frame(records), expected)
+    pd.testing.assert_frame_equal(_to_frame(dict(cols)), expected)
+
+
+def test_lazy_result_keeps_dataset():
+    res = ComtradeResult({}, RAGGED, "url", lazy=True)
+    assert res.dataset is RAGGED
+    assert list(res.df.columns) == ["a", "b", "c"]
+
+    res = ComtradeResult({}, RAGGED, "url")
+    assert res.dataset is None
+    assert len(res.df) == 3
+
+
+@pytest.mark.parametrize("streamed", STREAMED)
+@pytest.mark.parametrize("body, msg", [
+    ({"dataset": RAGGED}, "doesn't contain validation"),
+    ({"validation": {}}, "doesn't contain dataset"),
+    ({"validation": {}, "dataset": []}, "dataset is empty"),
+])
+def test_invalid_responses(ct, monkeypatch, streamed, body, msg):
+    if streamed:
+        monkeypatch.setattr(core, "_STREAM_THRESHOLD", 0)
+        if "validation" in body:
+            msg = "dataset is missing or empty"
+    r = _response(json.dumps(body).encode())
+    with pytest.raises(QueryError, match=msg):
+        ct._validation_dataset_response(r)
+
+
+@needs_ijson
+@pytest.mark.parametrize("lazy", [False, True])
+def test_streamed_response(ct, always_stream, lazy):
+    body = json.dumps({"validation": {"n": 3}, "dataset": RAGGED}).encode()
+    res = ct._validation_dataset_response(_response(body), lazy)
+    assert res.validation == {"n": 3}
+    assert (res.dataset is not None) == lazy
+    pd.testing.assert_frame_equal(res.df, pd.DataFrame(RAGGED))
+
+
+@pytest.mark.parametrize("streamed", STREAMED)
+def test_max_bytes_counts_decoded_body(monkeypatch, streamed):
+    if streamed:
+        monkeypatch.setattr(core, "_STREAM_THRESHOLD", 0)
+    body = json.dumps({"validation": {}, "dataset": RAGGED}).encode()
+    ct = Comtrade(token="x" * 152, cache_ttl=None, max_bytes=len(body) - 1)
+    with pytest.raises(QueryError, match="exceeds max_bytes"):
+        ct._validation_dataset_response(_response(body))
+
+    ct.max_bytes = len(body)
+    assert len(ct._validation_dataset_response(_response(body)).df) == 3
+
+
+def test_get_accepts_list_params(ct, monkeypatch):
+    calls = []
+    monkeypatch.setattr(ct, "_get", lambda lazy, kw: calls.append(kw) or kw)
+    assert ct.get(r=["1", "2"]) == {"r": ["1", "2"]}
+    assert ct.get(r={"a": 1}) == {"r": {"a": 1}}
+    assert len(calls) == 2 and not ct._inflight
+
+
+def test_get_many_dedups_list_params(ct, monkeypatch):
+    calls = []
+    monkeypatch.setattr(ct, "_get", lambda lazy, kw: calls.append(kw) or kw)
+    queries = [{"r": ["1", "2"]}, {"r": ["1", "2"]}, {"r": "3"},
+               {"r": {"a": 1}}, {"r": {"a": 1}}]
+    assert ct.get_many(queries) == queries
+    assert len(calls) == 4
+
+
+@needs_ijson
+def test_stream_threshold_uses_decoded_size(ct, monkeypatch):
+    body = json.dumps({"validation": {}, "dataset": RAGGED}).encode()
+    r = _response(body)
+    del r.headers["Content-Length"]
+    monkeypatch.setattr(core, "_STREAM_THRESHOLD", len(body) - 1)
+    # streamed results keep their records as columns
+    assert isinstance(ct._validation_dataset_response(r, True).dataset, dict)
+
+    monkeypatch.setattr(core, "_STREAM_THRESHOLD", len(body))
+    res = ct._validation_dataset_response(_response(body), True)
+    assert res.dataset == RAGGED
+
+
+@pytest.mark.skipif(core.requests_cache is None,
+                    reason="requests_cache is not installed")
+def test_cache_excludes_credentials_and_bulk(monkeypatch, tmp_path):
+    from requests_cache import DO_NOT_CACHE
+    from requests_cache.policy.expiration import get_url_expiration
+
+    monkeypatch.setattr(core, "DATA_DIR", str(tmp_path))
+    url = "http://example.com/api/"
+    ct = Comtrade(url=url, token="x" * 152, cache_ttl=123)
+    settings = ct.sess.settings
+
+    def expiration(path):
+        return get_url_expiration(url + path, settings.urls_expire_after)
+
+    for path in ["getAuthToken?username=u&password=p",
+                 "getSubUserToken?email=e", "getUserInfo?token=t",
+                 "get/bulk/C/A/2014/842/HS?token=t"]:
+        assert expiration(path) == DO_NOT_CACHE
+
+    for path in ["get?r=842&token=t", "refs/da/view?r=842",
+                 "refs/da/bulk?r=842"]:
+        assert expiration(path) == 123
+
+    assert {"token", "password"} <= set(settings.ignored_parameters)
+
+
+@pytest.fixture
+def token_source(monkeypatch, tmp_path):
+    monkeypatch.delenv(core.KEY_ENV_NAME, raising=False)
+    monkeypatch.setattr(core, "KEY_FILE_NAME", str(tmp_path / ".comtraderc"))
+
+    def set_token(source, token):
+        if source == "env":
+            monkeypatch.setenv(core.KEY_ENV_NAME, token)
+        else:
+            with open(core.KEY_FILE_NAME, "w") as f:
+                f.write(token)
+
+    return set_token
+
+
+@pytest.mark.parametrize("source", ["env", "file"])
+def test_long_token_is_truncated(token_source, source):
+    token = "a" * core._KEY_LEN + "b" * 8
+    token_source(source, token)
+    with pytest.warns(UserWarning, match="too long"):
+        ct = Comtrade(cache_ttl=None)
+    assert ct.token == "a" * core._KEY_LEN
+
+
+@pytest.mark.parametrize("source", ["env", "file"])
+def test_short_token_is_not_echoed(token_source, source):
+    token_source(source, "secret")
+    with pytest.raises(ValueError, match="too short") as err:
+        Comtrade(cache_ttl=None)
+    assert "secret" not in str(err.value)
+
+
+def test_explicit_token_is_used(token_source):
+    token_source("env", "e" * core._KEY_LEN)
+    ct = Comtrade(token="x" * core._KEY_LEN, cache_ttl=None)
+    assert ct.token == "x" * core._KEY_LEN
+
+
+def test_error_status_not_hidden_by_max_bytes(ct, monkeypatch):
+    r = _response(b"x" * 10000)
+    r.status_code = 500
+    monkeypatch.setattr(ct.sess, "get", lambda *args, **kwargs: r)
+    ct.max_bytes = 100
+    with pytest.raises(QueryError, match="status code 500") as err:
+        ct._make_request("get")
+    assert len(str(err.value)) < core._ERROR_BODY_BYTES + 100
+    assert r.raw.released
+
+
+@needs_ijson
+def test_streamed_response_closed_on_parse_error(ct, always_stream):
+    r = _response(b'{"validation": {}, "dataset": [{"a": 1}, {"a": ')
+    with pytest.raises(core.ijson.JSONError):
+        ct._validation_dataset_response(r)
+    assert r.raw.released